@@ -1,9 +1,20 @@
 import os
 import base64
-import json
-from flask import Flask, request, jsonify
-import requests
-from datetime import datetime, timedelta
+import atexit
+import gzip
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
+import httpx
+import orjson
+import redis
+from redis.exceptions import LockNotOwnedError
+from flask_caching import Cache
 from flask_cors import CORS
 # --------------------------------------------------------------------------
 # Optionally load environment variables from a .env file if desired.
@@ -14,16 +25,470 @@ try:
 except ImportError:
     pass
 
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, used by jsonify and request.json.
+    orjson encodes straight to bytes, so responses skip the str -> bytes step.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+logger = logging.getLogger(__name__)
+
+def _configure_logging():
+    """
+    Route this module's logs through a queue so formatting and writing to
+    stderr happen on a listener thread, not on the request thread.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+_configure_logging()
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Reject oversized uploads (413) before they are read, mostly to bound memory
+# use in the image recognition endpoint.
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
 CORS(app)
 # Read your FatSecret credentials from environment variables (or hardcode).
 FATSECRET_CLIENT_ID = os.getenv('FATSECRET_CLIENT_ID', 'YOUR_CLIENT_ID')
 FATSECRET_CLIENT_SECRET = os.getenv('FATSECRET_CLIENT_SECRET', 'YOUR_CLIENT_SECRET')
 
-# We'll store these in Python memory for demo. In production,
-# you'd likely store them elsewhere.
-cached_token = None
-token_expiry = None
+# The credentials never change at runtime, so the token request is built once.
+FATSECRET_TOKEN_URL = "https://oauth.fatsecret.com/connect/token"
+_BASIC_AUTH = "Basic " + base64.b64encode(f"{FATSECRET_CLIENT_ID}:{FATSECRET_CLIENT_SECRET}".encode("utf-8")).decode("utf-8")
+_TOKEN_HEADERS = {
+    "Authorization": _BASIC_AUTH,
+    "Content-Type": "application/x-www-form-urlencoded",
+}
+# Scope includes 'barcode' for barcode scanning.
+# Add other scopes like 'image-recognition' or 'premier' if your key has access and you plan to use them.
+_TOKEN_BODY = "grant_type=client_credentials&scope=basic barcode"
+
+# Requests a gevent worker serves concurrently (see gunicorn.conf.py).
+WORKER_CONNECTIONS = int(os.getenv('WORKER_CONNECTIONS', 500))
+
+# Per-attempt upstream timeouts, in seconds, and how often the transport
+# retries a failed connect.
+UPSTREAM_CONNECT_TIMEOUT = 3.0
+UPSTREAM_TIMEOUT = 10.0
+UPSTREAM_CONNECT_RETRIES = 2
+
+# One HTTP/2 client for every FatSecret call. Concurrent requests to the same
+# host are multiplexed over a single kept-alive connection instead of each
+# opening its own TCP+TLS connection (ALPN falls back to HTTP/1.1 pooling if
+# the server does not offer HTTP/2).
+http_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=UPSTREAM_CONNECT_RETRIES,  # connection failures only
+        # Sized so every in-flight request on this worker can get a connection
+        # without waiting on the pool, even if FatSecret falls back to HTTP/1.1.
+        limits=httpx.Limits(max_connections=WORKER_CONNECTIONS, max_keepalive_connections=64),
+    ),
+    timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+    # FatSecret's JSON compresses well; ask for gzip explicitly.
+    headers={"Accept-Encoding": "gzip"},
+)
+FATSECRET_API_URL = "https://platform.fatsecret.com/rest/server.api"
+# Static headers for form-encoded platform API calls. The bearer token is
+# added per call.
+_FS_FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+# Upstream statuses worth retrying, and the backoff between attempts.
+UPSTREAM_RETRY_STATUSES = frozenset([502, 503, 504])
+UPSTREAM_RETRIES = 2
+UPSTREAM_RETRY_BACKOFF = 0.2
+# Worst case for one _upstream_post(): every attempt uses up its connect
+# retries and its write and read timeouts, plus the backoff between attempts.
+UPSTREAM_MAX_SECONDS = (
+    (UPSTREAM_RETRIES + 1) * (UPSTREAM_CONNECT_TIMEOUT * (UPSTREAM_CONNECT_RETRIES + 1) + 2 * UPSTREAM_TIMEOUT)
+    + sum(UPSTREAM_RETRY_BACKOFF * 2 ** attempt for attempt in range(UPSTREAM_RETRIES))
+)
+# Chunk size used when relaying upstream bodies to the client.
+STREAM_CHUNK_SIZE = 8192
+# How long read-only FatSecret results stay cached, in seconds. Search results
+# change now and then; food details and barcode mappings are essentially static.
+SEARCH_CACHE_TIMEOUT = 300
+FOOD_CACHE_TIMEOUT = 24 * 60 * 60
+# Unknown barcodes (store brands, regional products) get rescanned a lot, so
+# "not found" answers are cached too, for less time in case FatSecret adds them.
+BARCODE_MISS_CACHE_TIMEOUT = 60 * 60
+# Food details batches run their upstream calls in parallel on this pool; the
+# threads share http_client's connections. Batches are capped to limit abuse.
+MAX_BATCH_FOOD_IDS = 25
+_batch_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='fatsecret-batch')
+
+# The OAuth token is shared through Redis so every gunicorn worker reuses the
+# same token. Without REDIS_URL (local development) we fall back to an
+# in-process cache.
+REDIS_URL = os.getenv('REDIS_URL')
+cache = Cache(app, config={
+    'CACHE_TYPE': 'RedisCache' if REDIS_URL else 'SimpleCache',
+    'CACHE_REDIS_URL': REDIS_URL,
+})
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+TOKEN_CACHE_KEY = f"fs:token:{FATSECRET_CLIENT_ID}"
+TOKEN_LOCK_KEY = f"{TOKEN_CACHE_KEY}:lock"
+TOKEN_ERROR_KEY = f"{TOKEN_CACHE_KEY}:error"
+# The lock must outlive the slowest possible token fetch.
+TOKEN_LOCK_TIMEOUT = UPSTREAM_MAX_SECONDS + 5
+# How long a request waits for another worker's refresh before giving up.
+TOKEN_LOCK_WAIT = 5
+# A failed refresh is remembered this long, so requests queued behind the
+# failing one share its error instead of each retrying the token endpoint.
+TOKEN_ERROR_CACHE_TIMEOUT = 5
+# Drop the cached token a minute before FatSecret does.
+TOKEN_EXPIRY_MARGIN = 60
+# Refresh in the background this long before the cached token is dropped.
+TOKEN_PREREFRESH_LEAD = 60
+# Used instead of the Redis lock when running without Redis.
+_local_token_lock = threading.Lock()
+# The pre-refresh timer armed by this worker, if any.
+_refresh_timer = None
+_refresh_timer_lock = threading.Lock()
+
+def _acquire_token_refresh_lock():
+    """
+    Acquire the lock guarding token refreshes, waiting up to TOKEN_LOCK_WAIT.
+    Backed by Redis so it is shared by every worker; a plain thread lock is
+    enough when the cache is in-process.
+    Returns the held lock, or None if it could not be acquired in time.
+    """
+    if redis_client is not None:
+        lock = redis_client.lock(TOKEN_LOCK_KEY, timeout=TOKEN_LOCK_TIMEOUT,
+                                 blocking_timeout=TOKEN_LOCK_WAIT)
+        return lock if lock.acquire() else None
+    return _local_token_lock if _local_token_lock.acquire(timeout=TOKEN_LOCK_WAIT) else None
+
+class FatSecretTokenError(Exception):
+    """
+    Raised when a new token cannot be obtained from FatSecret. Carries the
+    error response the token endpoint returns to its callers.
+    """
+    def __init__(self, error, details, status_code):
+        super().__init__(error)
+        self.error = error
+        self.details = details
+        self.status_code = status_code
+
+def _cached_token():
+    """
+    Return (access_token, expires_in) for the cached token, or None on a miss.
+    """
+    token = cache.get(TOKEN_CACHE_KEY)
+    if not token:
+        return None
+    expires_in = int(token['expires_at'] - time.time())
+    if expires_in <= TOKEN_EXPIRY_MARGIN:
+        return None
+    return token['access_token'], expires_in
+
+def _token_due_for_prerefresh():
+    """
+    True if the cached token is missing or within the pre-refresh window.
+    """
+    token = cache.get(TOKEN_CACHE_KEY)
+    if not token:
+        return True
+    remaining = token['expires_at'] - time.time()
+    return remaining <= TOKEN_EXPIRY_MARGIN + TOKEN_PREREFRESH_LEAD
+
+def _raise_recent_token_error():
+    """
+    Raise the error of a token refresh that failed moments ago, if any.
+    """
+    failure = cache.get(TOKEN_ERROR_KEY)
+    if failure:
+        raise FatSecretTokenError(failure['error'], failure['details'], failure['status_code'])
+
+def _refresh_token_locked(prerefresh=False):
+    """
+    Fetch a new token while holding the refresh lock, so that when the token
+    expires only one worker calls FatSecret and the rest reuse its result.
+    Returns (access_token, expires_in). With prerefresh=True a still-cached
+    token is replaced if it is about to expire.
+    """
+    def refresh():
+        # Another worker may have refreshed, or failed to, while we waited.
+        if not prerefresh or not _token_due_for_prerefresh():
+            cached = _cached_token()
+            if cached:
+                return cached
+        _raise_recent_token_error()
+        try:
+            return _fetch_new_token()
+        except FatSecretTokenError as e:
+            cache.set(TOKEN_ERROR_KEY, {
+                'error': e.error,
+                'details': e.details,
+                'status_code': e.status_code,
+            }, timeout=TOKEN_ERROR_CACHE_TIMEOUT)
+            raise
+
+    lock = _acquire_token_refresh_lock()
+    if lock is None:
+        # The lock holder is taking too long. Use its result if it has landed,
+        # but don't pile onto the token endpoint ourselves.
+        logger.warning("Timed out waiting for the token refresh lock")
+        cached = _cached_token()
+        if cached:
+            return cached
+        _raise_recent_token_error()
+        raise FatSecretTokenError(
+            'Timed out waiting for token refresh',
+            'Another request is still fetching a FatSecret token',
+            503
+        )
+
+    try:
+        return refresh()
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            # Our refresh outlived the lock; another worker may hold it now.
+            logger.warning("Token refresh lock expired before it was released")
+
+def _schedule_token_prerefresh(expires_at):
+    """
+    Arm a background timer that refreshes the token shortly before it leaves
+    the cache, so user requests never wait on the OAuth round-trip.
+    Replaces any timer this worker already has armed.
+    """
+    global _refresh_timer
+    delay = expires_at - time.time() - TOKEN_EXPIRY_MARGIN - TOKEN_PREREFRESH_LEAD
+    if delay <= 0:
+        return
+    with _refresh_timer_lock:
+        if _refresh_timer is not None:
+            _refresh_timer.cancel()
+        _refresh_timer = threading.Timer(delay, _prerefresh_token)
+        _refresh_timer.daemon = True
+        _refresh_timer.start()
+
+def _prerefresh_token():
+    """
+    Timer callback: refresh the token if no other worker has done so yet, and
+    re-arm the timer for whichever token ends up in the cache.
+    """
+    global _refresh_timer
+    with _refresh_timer_lock:
+        _refresh_timer = None
+    try:
+        _refresh_token_locked(prerefresh=True)
+    except Exception as e:
+        logger.error("Exception during background token refresh: %s", e)
+    token = cache.get(TOKEN_CACHE_KEY)
+    if token and _refresh_timer is None:
+        _schedule_token_prerefresh(token['expires_at'])
+
+def _get_valid_token():
+    """
+    Return a valid access token, reading the shared cache first and only
+    asking FatSecret for a new one on a miss. Every proxy handler gets its
+    token through here.
+    Raises FatSecretTokenError if no token can be obtained.
+    """
+    cached = _cached_token()
+    if cached:
+        return cached[0]
+    return _refresh_token_locked()[0]
+
+def _token_error_response(e):
+    """
+    Turn a FatSecretTokenError into the JSON error response sent to clients.
+    """
+    return jsonify({
+        'error': e.error,
+        'details': e.details
+    }), e.status_code
+
+def _upstream_post(url, stream=False, **kwargs):
+    """
+    POST to FatSecret through the shared client, retrying 502/503/504 with a
+    short exponential backoff. With stream=True the response body is left
+    unread; the caller must read() or close() it.
+    """
+    upstream_request = http_client.build_request('POST', url, **kwargs)
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        response = http_client.send(upstream_request, stream=stream)
+        if response.status_code not in UPSTREAM_RETRY_STATUSES or attempt == UPSTREAM_RETRIES:
+            return response
+        response.close()
+        time.sleep(UPSTREAM_RETRY_BACKOFF * 2 ** attempt)
+
+def _fs_call(method, stream=False, files=None, **params):
+    """
+    Call a FatSecret platform API method with the current access token.
+    params become form fields; with files the request is sent as multipart.
+    Raises FatSecretTokenError if no token can be obtained.
+    """
+    headers = {"Authorization": f"Bearer {_get_valid_token()}"}
+    if files is None:
+        headers.update(_FS_FORM_HEADERS)
+    form_data = {"method": method, "format": "json", **params}
+    return _upstream_post(FATSECRET_API_URL, stream=stream, headers=headers, data=form_data, files=files)
+
+def _proxy_fs_call(method, action, cache_key=None, cache_timeout=None, files=None, **params):
+    """
+    Call a FatSecret method and stream its response back to the client,
+    turning token, HTTP and upstream status failures into JSON errors.
+    action names the call in error messages, e.g. 'FatSecret search'.
+    """
+    try:
+        response = _fs_call(method, stream=True, files=files, **params)
+        logger.debug("FatSecret %s response status: %s", method, response.status_code)
+
+        if response.status_code != 200:
+            response.read()
+            return jsonify({
+                'error': f'FatSecret API returned status {response.status_code}',
+                'details': response.text
+            }), response.status_code
+
+        return _stream_upstream(response, cache_key, cache_timeout)
+    except FatSecretTokenError as e:
+        return _token_error_response(e)
+    except httpx.HTTPError as e:
+        logger.error("Request exception: %s", e)
+        return jsonify({
+            'error': f'Exception during {action} request',
+            'details': str(e)
+        }), 500
+    except Exception as e:
+        logger.exception("Unexpected error: %s", e)
+        return jsonify({
+            'error': f'Unexpected exception during {action}',
+            'details': str(e)
+        }), 500
+
+def _cache_bypassed():
+    """
+    True when the caller asked to skip the response cache (?nocache=1).
+    """
+    return request.args.get('nocache') == '1'
+
+def _client_accepts_gzip():
+    """
+    True if the current client accepts a gzip-encoded response body.
+    """
+    # Quality, not membership: werkzeug keeps 'gzip;q=0' entries.
+    return request.accept_encodings['gzip'] > 0
+
+def _cached_upstream_response(cache_key):
+    """
+    Return the cached FatSecret body for cache_key as a response, or None on a
+    miss (or when the cache is bypassed). A gzip body is sent as-is to clients
+    that accept gzip and decompressed for the rest.
+    """
+    if _cache_bypassed():
+        return None
+    entry = cache.get(cache_key)
+    if entry is None:
+        return None
+
+    body = entry['body']
+    headers = {'X-Cache': 'HIT'}
+    if entry.get('content_encoding') == 'gzip':
+        headers['Vary'] = 'Accept-Encoding'
+        if _client_accepts_gzip():
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            body = gzip.decompress(body)
+    return Response(body, status=200, content_type=entry['content_type'], headers=headers)
+
+def _cache_upstream_body(cache_key, body, content_type, content_encoding, timeout):
+    """
+    Cache a FatSecret body, unless it is one of FatSecret's 200-with-error
+    responses (expired token, unknown id, ...), which must not be replayed.
+    """
+    try:
+        decoded = gzip.decompress(body) if content_encoding == 'gzip' else body
+        if 'error' in orjson.loads(decoded):
+            return
+    except (OSError, orjson.JSONDecodeError):
+        return
+    cache.set(cache_key, {
+        'body': body,
+        'content_type': content_type,
+        'content_encoding': content_encoding,
+    }, timeout=timeout)
+
+def _stream_upstream(response, cache_key=None, cache_timeout=None):
+    """
+    Relay a FatSecret response (requested with stream=True) to the client chunk
+    by chunk, instead of buffering it and re-encoding it with jsonify.
+    A gzip body is relayed still compressed when the client accepts gzip, so
+    it is never decompressed here; otherwise it is decoded on the way through.
+    With a cache_key, the relayed chunks are also collected and cached once the
+    body has been fully sent.
+    """
+    content_type = response.headers.get('Content-Type', 'application/json')
+    headers = {}
+
+    content_encoding = None
+    chunks = response.iter_bytes(STREAM_CHUNK_SIZE)
+    if response.headers.get('Content-Encoding') == 'gzip':
+        headers['Vary'] = 'Accept-Encoding'
+        if _client_accepts_gzip():
+            content_encoding = 'gzip'
+            headers['Content-Encoding'] = 'gzip'
+            if 'Content-Length' in response.headers:
+                headers['Content-Length'] = response.headers['Content-Length']
+            chunks = response.iter_raw(STREAM_CHUNK_SIZE)
+
+    if cache_key is None:
+        body = chunks
+    else:
+        headers['X-Cache'] = 'MISS'
+
+        def body():
+            collected = []
+            for chunk in chunks:
+                collected.append(chunk)
+                yield chunk
+            _cache_upstream_body(cache_key, b''.join(collected), content_type,
+                                 content_encoding, cache_timeout)
+        body = body()
+
+    proxied = Response(body, status=response.status_code, content_type=content_type,
+                       headers=headers)
+    proxied.call_on_close(response.close)
+    return proxied
+
+# Proxy endpoints whose bodies should reach the client as they are produced.
+_UNBUFFERED_PATHS = frozenset([
+    '/fatsecret_search',
+    '/fatsecret_food_details',
+    '/fatsecret_image_recognition',
+    '/fatsecret_barcode_lookup',
+])
+
+@app.after_request
+def _disable_proxy_buffering(response):
+    """
+    Ask reverse proxies (nginx, Cloudflare) not to buffer or re-encode the
+    proxy endpoints' responses, so streamed chunks are forwarded immediately.
+    """
+    if request.path in _UNBUFFERED_PATHS:
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.headers['Cache-Control'] = 'no-transform'
+    return response
 
 @app.route('/')
 def health_check():
@@ -41,57 +506,60 @@ def get_fatsecret_token():
     """
     Endpoint to retrieve (and cache) a FatSecret API OAuth2 token.
     """
-    global cached_token, token_expiry
-
-    if cached_token and token_expiry and datetime.now() < token_expiry:
-        return jsonify({
-            'access_token': cached_token,
-            'expires_in': (token_expiry - datetime.now()).seconds
-        }), 200
-
-    token_url = "https://oauth.fatsecret.com/connect/token"
-    auth_string = base64.b64encode(f"{FATSECRET_CLIENT_ID}:{FATSECRET_CLIENT_SECRET}".encode("utf-8")).decode("utf-8")
-
-    headers = {
-        "Authorization": f"Basic {auth_string}",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-    # Updated scope to include 'barcode' for barcode scanning
-    # Add other scopes like 'image-recognition' or 'premier' if your key has access and you plan to use them.
-    body = "grant_type=client_credentials&scope=basic barcode" # MODIFIED
+    try:
+        access_token, expires_in = _cached_token() or _refresh_token_locked()
+    except FatSecretTokenError as e:
+        return _token_error_response(e)
+    return jsonify({
+        'access_token': access_token,
+        'expires_in': expires_in
+    }), 200
 
+def _fetch_new_token():
+    """
+    Request a new OAuth2 token from FatSecret and store it in the shared cache.
+    Returns (access_token, expires_in); raises FatSecretTokenError on failure.
+    """
     try:
-        response = requests.post(token_url, headers=headers, data=body)
+        response = _upstream_post(FATSECRET_TOKEN_URL, headers=_TOKEN_HEADERS, content=_TOKEN_BODY)
         if response.status_code == 200:
-            data = json.loads(response.text)
-            cached_token = data['access_token']
+            data = orjson.loads(response.content)
+            access_token = data['access_token']
             expires_in = data['expires_in']
-            token_expiry = datetime.now() + timedelta(seconds=expires_in)
-            return jsonify({
-                'access_token': cached_token,
-                'expires_in': expires_in
-            }), 200
+            # Wall-clock time rather than time.monotonic(): the entry is shared
+            # by workers that may run on different hosts.
+            expires_at = time.time() + expires_in
+            cache.set(TOKEN_CACHE_KEY, {
+                'access_token': access_token,
+                'expires_at': expires_at,
+            }, timeout=max(expires_in - TOKEN_EXPIRY_MARGIN, 1))
+            _schedule_token_prerefresh(expires_at)
+            return access_token, expires_in
         else:
-            error_details = response.text
+            # Parse the raw bytes first; only decode the body to text if it
+            # carries no usable error field.
+            error_details = None
             try:
-                error_json = response.json()
+                error_json = orjson.loads(response.content)
                 if 'error_description' in error_json:
                     error_details = error_json['error_description']
                 elif 'error' in error_json:
                     error_details = error_json['error']
-            except ValueError:
-                pass # Keep original response.text if not JSON
-            print(f"FatSecret token request failed with status {response.status_code}: {error_details}")
-            return jsonify({
-                'error': f"FatSecret token request failed: {response.status_code}",
-                'details': error_details
-            }), 400
+            except orjson.JSONDecodeError:
+                pass # Fall back to response.text if not JSON
+            if error_details is None:
+                error_details = response.text
+            logger.error("FatSecret token request failed with status %s: %s", response.status_code, error_details)
+            raise FatSecretTokenError(
+                f"FatSecret token request failed: {response.status_code}",
+                error_details,
+                400
+            )
+    except FatSecretTokenError:
+        raise
     except Exception as e:
-        print(f"Exception during token fetch: {str(e)}")
-        return jsonify({
-            'error': 'Exception during token fetch',
-            'details': str(e)
-        }), 500
+        logger.error("Exception during token fetch: %s", e)
+        raise FatSecretTokenError('Exception during token fetch', str(e), 500) from e
 
 @app.route('/fatsecret_search', methods=['POST'])
 def search_foods():
@@ -99,8 +567,6 @@ def search_foods():
     Proxy endpoint for FatSecret food search to avoid CORS issues in web browsers.
     Flutter calls this endpoint instead of calling FatSecret directly.
     """
-    global cached_token, token_expiry
-    
     # Get the search query from the request
     data = request.json
     if not data:
@@ -116,76 +582,22 @@ def search_foods():
         
     page_number = data.get('page_number', '0')
     max_results = data.get('max_results', '10')
-    
-    # Ensure we have a valid token
-    if not cached_token or not token_expiry or datetime.now() >= token_expiry:
-        # Get a new token if needed
-        try:
-            token_response = get_fatsecret_token()
-            if isinstance(token_response, tuple) and token_response[1] != 200:
-                return token_response
-        except Exception as e:
-            return jsonify({
-                'error': 'Failed to get token',
-                'details': str(e)
-            }), 500
-    
-    # Call FatSecret API
-    fatsecret_url = "https://platform.fatsecret.com/rest/server.api"
-    headers = {
-        "Authorization": f"Bearer {cached_token}",
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    
-    # Create form data instead of JSON payload
+
+    cache_key = f"fs:search:{query}:{page_number}:{max_results}"
+    cached = _cached_upstream_response(cache_key)
+    if cached:
+        return cached
+
+    logger.debug("Sending request to FatSecret with query: %s", query)
     # Use foods.search instead of foods.search.v2 (which might require premier scope)
-    form_data = {
-        "method": "foods.search",
-        "search_expression": query,
-        "format": "json",
-        "page_number": page_number,
-        "max_results": max_results
-    }
-    
-    try:
-        print(f"Sending request to FatSecret with query: {query}")
-        # Use data parameter for form data instead of json parameter
-        response = requests.post(fatsecret_url, headers=headers, data=form_data)
-        print(f"FatSecret response status: {response.status_code}")
-        
-        # Print the first part of the response for debugging
-        response_preview = response.text[:min(500, len(response.text))]
-        print(f"FatSecret response preview: {response_preview}")
-        
-        if response.status_code != 200:
-            return jsonify({
-                'error': f'FatSecret API returned status {response.status_code}',
-                'details': response.text
-            }), response.status_code
-            
-        # Try to parse the response as JSON
-        response_data = response.json()
-        return jsonify(response_data), 200
-    except requests.RequestException as e:
-        print(f"Request exception: {str(e)}")
-        return jsonify({
-            'error': 'Exception during FatSecret search request',
-            'details': str(e)
-        }), 500
-    except json.JSONDecodeError as e:
-        print(f"JSON decode error: {str(e)}")
-        print(f"Raw response: {response.text}")
-        return jsonify({
-            'error': 'Failed to parse FatSecret response as JSON',
-            'details': str(e),
-            'response': response.text
-        }), 500
-    except Exception as e:
-        print(f"Unexpected error: {str(e)}")
-        return jsonify({
-            'error': 'Unexpected exception during FatSecret search',
-            'details': str(e)
-        }), 500
+    return _proxy_fs_call(
+        'foods.search', 'FatSecret search',
+        cache_key=cache_key,
+        cache_timeout=SEARCH_CACHE_TIMEOUT,
+        search_expression=query,
+        page_number=page_number,
+        max_results=max_results
+    )
 
 @app.route('/fatsecret_food_details', methods=['POST'])
 def get_food_details():
@@ -193,8 +605,6 @@ def get_food_details():
     Proxy endpoint for FatSecret food details to avoid CORS issues in web browsers.
     Flutter calls this endpoint instead of calling FatSecret directly.
     """
-    global cached_token, token_expiry
-    
     # Get the food ID from the request
     data = request.json
     if not data:
@@ -207,73 +617,98 @@ def get_food_details():
         return jsonify({
             'error': 'No food ID provided'
         }), 400
-    
-    # Ensure we have a valid token
-    if not cached_token or not token_expiry or datetime.now() >= token_expiry:
-        # Get a new token if needed
-        try:
-            token_response = get_fatsecret_token()
-            if isinstance(token_response, tuple) and token_response[1] != 200:
-                return token_response
-        except Exception as e:
-            return jsonify({
-                'error': 'Failed to get token',
-                'details': str(e)
-            }), 500
-    
-    # Call FatSecret API
-    fatsecret_url = "https://platform.fatsecret.com/rest/server.api"
-    headers = {
-        "Authorization": f"Bearer {cached_token}",
-        "Content-Type": "application/x-www-form-urlencoded"  # Changed from application/json
-    }
-    
-    # Create form data instead of JSON payload
-    form_data = {
-        "method": "food.get.v2",  # Using v2 instead of v4 which might require premier
-        "food_id": food_id,
-        "format": "json"
-    }
-    
+
+    cache_key = f"fs:food:{food_id}"
+    cached = _cached_upstream_response(cache_key)
+    if cached:
+        return cached
+
+    logger.debug("Sending food details request to FatSecret for food ID: %s", food_id)
+    # Using v2 instead of v4 which might require premier
+    return _proxy_fs_call(
+        'food.get.v2', 'FatSecret food details',
+        cache_key=cache_key,
+        cache_timeout=FOOD_CACHE_TIMEOUT,
+        food_id=food_id
+    )
+
+def _fetch_food_details(food_id, use_cache):
+    """
+    Return the parsed food.get.v2 result for one food, or an error object for
+    it, going through the food details cache. Runs on _batch_executor, outside
+    the request context.
+    """
+    cache_key = f"fs:food:{food_id}"
     try:
-        print(f"Sending food details request to FatSecret for food ID: {food_id}")
-        # Use data parameter for form data instead of json parameter
-        response = requests.post(fatsecret_url, headers=headers, data=form_data)
-        print(f"FatSecret food details response status: {response.status_code}")
-        
-        # Print the first part of the response for debugging
-        response_preview = response.text[:min(500, len(response.text))]
-        print(f"FatSecret food details response preview: {response_preview}")
-        
+        entry = cache.get(cache_key) if use_cache else None
+        if entry is not None:
+            body = entry['body']
+            if entry.get('content_encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return orjson.loads(body)
+
+        response = _fs_call('food.get.v2', food_id=food_id)
         if response.status_code != 200:
-            return jsonify({
+            return {
+                'food_id': food_id,
                 'error': f'FatSecret API returned status {response.status_code}',
                 'details': response.text
-            }), response.status_code
-            
-        # Try to parse the response as JSON
-        response_data = response.json()
-        return jsonify(response_data), 200
-    except requests.RequestException as e:
-        print(f"Request exception: {str(e)}")
+            }
+        content_type = response.headers.get('Content-Type', 'application/json')
+        _cache_upstream_body(cache_key, response.content, content_type, None, FOOD_CACHE_TIMEOUT)
+        return orjson.loads(response.content)
+    except FatSecretTokenError as e:
+        return {'food_id': food_id, 'error': e.error, 'details': e.details}
+    except httpx.HTTPError as e:
+        logger.error("Request exception: %s", e)
+        return {'food_id': food_id, 'error': 'Exception during FatSecret food details request', 'details': str(e)}
+    except orjson.JSONDecodeError as e:
+        return {'food_id': food_id, 'error': 'Failed to parse FatSecret food details response', 'details': str(e)}
+    except Exception as e:
+        logger.exception("Unexpected error: %s", e)
+        return {'food_id': food_id, 'error': 'Unexpected exception during FatSecret food details fetch', 'details': str(e)}
+
+@app.route('/fatsecret_food_details_batch', methods=['POST'])
+def get_food_details_batch():
+    """
+    Fetch details for several foods in one call. The FatSecret requests are
+    issued in parallel, so a batch costs roughly one upstream round-trip.
+    Results are returned in the order of the requested food IDs.
+    """
+    data = request.json
+    if not data:
         return jsonify({
-            'error': 'Exception during FatSecret food details request',
-            'details': str(e)
-        }), 500
-    except json.JSONDecodeError as e:
-        print(f"JSON decode error: {str(e)}")
-        print(f"Raw response: {response.text}")
+            'error': 'No JSON data received'
+        }), 400
+
+    food_ids = data.get('food_ids')
+    if not food_ids or not isinstance(food_ids, list):
         return jsonify({
-            'error': 'Failed to parse FatSecret food details response as JSON',
-            'details': str(e),
-            'response': response.text
-        }), 500
-    except Exception as e:
-        print(f"Unexpected error: {str(e)}")
+            'error': 'No food IDs provided'
+        }), 400
+    if len(food_ids) > MAX_BATCH_FOOD_IDS:
         return jsonify({
-            'error': 'Unexpected exception during FatSecret food details fetch',
-            'details': str(e)
-        }), 500
+            'error': f'Too many food IDs (max {MAX_BATCH_FOOD_IDS})'
+        }), 400
+    # Same rule as /fatsecret_food_details: every ID must be present and non-empty.
+    if not all(isinstance(food_id, (str, int)) and not isinstance(food_id, bool) and food_id != ''
+               for food_id in food_ids):
+        return jsonify({
+            'error': 'Each food ID must be a non-empty string or integer'
+        }), 400
+
+    # Fail the whole batch up front if there is no token, rather than per item.
+    try:
+        _get_valid_token()
+    except FatSecretTokenError as e:
+        return _token_error_response(e)
+
+    logger.debug("Sending %s food details requests to FatSecret", len(food_ids))
+    use_cache = not _cache_bypassed()
+    futures = [_batch_executor.submit(_fetch_food_details, food_id, use_cache) for food_id in food_ids]
+    return jsonify({
+        'results': [future.result() for future in futures]
+    }), 200
 
 @app.route('/fatsecret_image_recognition', methods=['POST'])
 def recognize_food_from_image():
@@ -281,8 +716,6 @@ def recognize_food_from_image():
     Proxy endpoint for FatSecret's image recognition API.
     This endpoint accepts an image file and sends it to FatSecret for food recognition.
     """
-    global cached_token, token_expiry
-    
     # Check if an image file was uploaded
     if 'image' not in request.files:
         return jsonify({
@@ -294,80 +727,19 @@ def recognize_food_from_image():
         return jsonify({
             'error': 'Empty image file'
         }), 400
-    
-    # Ensure we have a valid token
-    if not cached_token or not token_expiry or datetime.now() >= token_expiry:
-        # Get a new token if needed
-        try:
-            token_response = get_fatsecret_token()
-            if isinstance(token_response, tuple) and token_response[1] != 200:
-                return token_response
-        except Exception as e:
-            return jsonify({
-                'error': 'Failed to get token',
-                'details': str(e)
-            }), 500
-    
-    # Call FatSecret Image Recognition API
-    fatsecret_url = "https://platform.fatsecret.com/rest/server.api"
-    headers = {
-        "Authorization": f"Bearer {cached_token}"
+
+    logger.debug("Sending image recognition request to FatSecret")
+    files = {
+        # Hand httpx the upload stream rather than a bytes copy of it
+        'image': (image_file.filename, image_file.stream, image_file.content_type)
     }
-    
-    try:
-        print("Sending image recognition request to FatSecret")
-        
-        # Create a multipart form-data request
-        files = {
-            'method': (None, 'food.recognize'),
-            'format': (None, 'json'),
-            'image': (image_file.filename, image_file.read(), image_file.content_type)
-        }
-        
-        response = requests.post(fatsecret_url, headers=headers, files=files)
-        print(f"FatSecret image recognition response status: {response.status_code}")
-        
-        # Print the first part of the response for debugging
-        response_preview = response.text[:min(500, len(response.text))]
-        print(f"FatSecret image recognition response preview: {response_preview}")
-        
-        if response.status_code != 200:
-            return jsonify({
-                'error': f'FatSecret API returned status {response.status_code}',
-                'details': response.text
-            }), response.status_code
-            
-        # Try to parse the response as JSON
-        response_data = response.json()
-        return jsonify(response_data), 200
-    except requests.RequestException as e:
-        print(f"Request exception: {str(e)}")
-        return jsonify({
-            'error': 'Exception during FatSecret image recognition request',
-            'details': str(e)
-        }), 500
-    except json.JSONDecodeError as e:
-        print(f"JSON decode error: {str(e)}")
-        print(f"Raw response: {response.text}")
-        return jsonify({
-            'error': 'Failed to parse FatSecret image recognition response as JSON',
-            'details': str(e),
-            'response': response.text
-        }), 500
-    except Exception as e:
-        print(f"Unexpected error: {str(e)}")
-        return jsonify({
-            'error': 'Unexpected exception during FatSecret image recognition',
-            'details': str(e)
-        }), 500
+    return _proxy_fs_call('food.recognize', 'FatSecret image recognition', files=files)
 
 @app.route('/fatsecret_barcode_lookup', methods=['POST'])
 def lookup_barcode():
     """
     Proxy endpoint for FatSecret food.find_id_for_barcode.
     """
-    global cached_token, token_expiry
-
     data = request.json
     if not data:
         return jsonify({'error': 'No JSON data received'}), 400
@@ -376,38 +748,18 @@ def lookup_barcode():
     if not barcode:
         return jsonify({'error': 'No barcode provided'}), 400
 
-    # Ensure we have a valid token
-    if not cached_token or not token_expiry or datetime.now() >= token_expiry:
-        try:
-            token_response_tuple = get_fatsecret_token() # get_fatsecret_token returns a tuple
-            token_data = token_response_tuple[0].get_json() if token_response_tuple[0] else None
-            status_code = token_response_tuple[1]
-
-            if status_code != 200 or not token_data or 'access_token' not in token_data :
-                print(f"Failed to refresh token for barcode lookup. Status: {status_code}, Data: {token_data}")
-                return jsonify({'error': 'Failed to refresh token for barcode lookup', 'details': token_data.get('details', 'Unknown token error') if token_data else 'Unknown token error'}), status_code
-            # cached_token is updated globally by get_fatsecret_token
-        except Exception as e:
-            print(f"Exception refreshing token for barcode lookup: {str(e)}")
-            return jsonify({'error': 'Exception refreshing token', 'details': str(e)}), 500
-    
-    fatsecret_url = "https://platform.fatsecret.com/rest/server.api"
-    headers = {
-        "Authorization": f"Bearer {cached_token}",
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    form_data = {
-        "method": "food.find_id_for_barcode",
-        "barcode": barcode,
-        "format": "json"
-    }
+    cache_key = f"fs:barcode:{barcode}"
+    if not _cache_bypassed():
+        cached = cache.get(cache_key)
+        if cached and cached.get('miss'):
+            return jsonify({'error': 'Food not found for this barcode'}), 404, {'X-Cache': 'HIT'}
+        if cached:
+            return jsonify({'food_id': cached['food_id']}), 200, {'X-Cache': 'HIT'}
 
     try:
-        print(f"Sending barcode lookup request to FatSecret for barcode: {barcode}")
-        response = requests.post(fatsecret_url, headers=headers, data=form_data)
-        print(f"FatSecret barcode lookup response status: {response.status_code}")
-        response_preview = response.text[:min(500, len(response.text))]
-        print(f"FatSecret barcode lookup response preview: {response_preview}")
+        logger.debug("Sending barcode lookup request to FatSecret for barcode: %s", barcode)
+        response = _fs_call('food.find_id_for_barcode', barcode=barcode)
+        logger.debug("FatSecret barcode lookup response status: %s", response.status_code)
 
         if response.status_code != 200:
             return jsonify({
@@ -415,31 +767,41 @@ def lookup_barcode():
                 'details': response.text
             }), response.status_code
             
-        response_data = response.json()
+        response_data = orjson.loads(response.content)
 
         if 'error' in response_data:
             error_message = response_data['error'].get('message', 'Food not found for this barcode or API error.')
             if "no item found" in error_message.lower():
-                return jsonify({'error': 'Food not found for this barcode'}), 404
+                cache.set(cache_key, {'miss': True}, timeout=BARCODE_MISS_CACHE_TIMEOUT)
+                return jsonify({'error': 'Food not found for this barcode'}), 404, {'X-Cache': 'MISS'}
             return jsonify({'error': error_message, 'details': response_data['error']}), 400
 
         food_id_data = response_data.get('food_id')
         if food_id_data and isinstance(food_id_data, dict) and 'value' in food_id_data:
             food_id_value = food_id_data['value']
             if food_id_value and food_id_value != '0':
-                return jsonify({'food_id': food_id_value}), 200
+                cache.set(cache_key, {'food_id': food_id_value}, timeout=FOOD_CACHE_TIMEOUT)
+                return jsonify({'food_id': food_id_value}), 200, {'X-Cache': 'MISS'}
         
         # This will be reached if food_id is not in response, or is malformed, or has value "0" or null.
         # This is treated as "not found" from the client's perspective.
-        return jsonify({'error': 'Food not found for this barcode', 'details': response_data}), 404
+        cache.set(cache_key, {'miss': True}, timeout=BARCODE_MISS_CACHE_TIMEOUT)
+        return jsonify({'error': 'Food not found for this barcode', 'details': response_data}), 404, {'X-Cache': 'MISS'}
 
-    except requests.RequestException as e:
+    except FatSecretTokenError as e:
+        logger.error("Failed to refresh token for barcode lookup. Status: %s, Details: %s", e.status_code, e.details)
+        return jsonify({'error': 'Failed to refresh token for barcode lookup', 'details': e.details}), e.status_code
+    except httpx.HTTPError as e:
         return jsonify({'error': 'Exception during FatSecret barcode lookup', 'details': str(e)}), 500
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         return jsonify({'error': 'Failed to parse FatSecret barcode lookup response', 'details': str(e), 'response': response.text}), 500
     except Exception as e:
         return jsonify({'error': 'Unexpected exception during barcode lookup', 'details': str(e)}), 500
 
 if __name__ == '__main__':
+    # Local development only. In production the app is served by gunicorn with
+    # gevent workers (see gunicorn.conf.py), which monkey-patch the standard
+    # library before importing this module so upstream calls overlap. Locally:
+    #   gunicorn -c gunicorn.conf.py fatsecret_backend:app
     # Confirm you're using port 5001 if your Dart code is set to 5001
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv('FLASK_DEBUG') == '1')
\ No newline at end of file
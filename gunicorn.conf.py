@@ -0,0 +1,10 @@
+import os
+
+# Every handler spends nearly all of its time waiting on FatSecret, so each
+# gevent worker keeps many requests in flight at once on cooperative
+# greenlets. WORKER_CONNECTIONS is also read by fatsecret_backend to size its
+# upstream connection pool, so a worker never queues on the pool.
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 500))